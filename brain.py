@@ -21,7 +21,6 @@ This module contains classes to represent different elements of a brain simulati
 import logging
 from typing import List, Mapping, Tuple, Dict, Any
 import numpy as np
-import heapq
 from collections import defaultdict
 
 from numpy.core._multiarray_umath import ndarray
@@ -30,6 +29,65 @@ from scipy.stats import truncnorm
 import math
 import random
 
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional, the NumPy implementations below are used without it.
+    njit = prange = None
+
+# Number of target neurons handled by one thread in the compiled '_add_winner_rows'.
+_PARALLEL_BLOCK_SIZE = 2048
+
+
+def _bernoulli(shape, p: float) -> ndarray:
+    """Sample a float32 array of the given shape with i.i.d. Bernoulli(p) entries."""
+    return (np.random.random_sample(shape) < p).astype(np.float32)
+
+
+def _top_k(values: ndarray, k: int) -> ndarray:
+    """Indices of the 'k' largest 'values', in decreasing order of value.
+
+    Ties are broken by lower index (as heapq.nlargest does), so existing support neurons win over new candidates
+    with the same input.
+    """
+    kth_value = np.partition(values, -k)[-k]
+    above = np.flatnonzero(values > kth_value)
+    tied = np.flatnonzero(values == kth_value)[:k - len(above)]
+    indices = np.concatenate((above, tied))
+    return indices[np.lexsort((indices, -values[indices]))]
+
+
+def _add_winner_rows(inputs: ndarray, connectome: ndarray, winners: ndarray) -> None:
+    """Add the rows of 'connectome' belonging to 'winners' into 'inputs', in place."""
+    for w in winners:
+        inputs += connectome[w]
+
+
+def _scale_winner_block(connectome: ndarray, rows: ndarray, columns: ndarray, factor: float) -> None:
+    """Multiply the entries of 'connectome' at ('rows' x 'columns') by 'factor', in place."""
+    connectome[np.ix_(rows, columns)] *= factor
+
+
+if njit is not None:
+    # Compiled versions of the two functions above. They work directly on the connectome without building
+    # temporary arrays or row views, and the inner loops are vectorized by LLVM.
+    # '_add_winner_rows' splits the target neurons into blocks that are summed on separate threads; every thread
+    # writes a disjoint slice of 'inputs', so no reduction between threads is needed.
+    @njit(cache=True, fastmath=True, nogil=True, parallel=True)
+    def _add_winner_rows(inputs, connectome, winners):  # noqa: F811
+        n = inputs.shape[0]
+        for block in prange((n + _PARALLEL_BLOCK_SIZE - 1) // _PARALLEL_BLOCK_SIZE):
+            start = block * _PARALLEL_BLOCK_SIZE
+            end = min(start + _PARALLEL_BLOCK_SIZE, n)
+            block_inputs = inputs[start:end]
+            for w in winners:
+                block_inputs += connectome[w, start:end]
+
+    @njit(cache=True, fastmath=True, nogil=True)
+    def _scale_winner_block(connectome, rows, columns, factor):  # noqa: F811
+        for r in rows:
+            for c in columns:
+                connectome[r, c] *= factor
+
 
 class Stimulus:
     """ Represents a random stimulus that can be applied to any part of the brain.
@@ -141,7 +199,7 @@ class Brain:
         self.stimuli[name]: Stimulus = Stimulus(k)
         new_connectomes: Dict[str, ndarray] = {}
         for key in self.areas:
-            new_connectomes[key] = np.empty((0, 0))
+            new_connectomes[key] = np.empty(0, dtype=np.float32)
             self.areas[key].stimulus_beta[name] = self.areas[key].beta
         self.stimuli_connectomes[name] = new_connectomes
 
@@ -163,14 +221,14 @@ class Brain:
         self.areas[name] = Area(name, n, k, beta)
 
         for stim_name, stim_connectomes in self.stimuli_connectomes.items():
-            stim_connectomes[name] = np.empty(0)  # TODO: Should this be np.empty((0,0))?
+            stim_connectomes[name] = np.empty(0, dtype=np.float32)  # TODO: Should this be np.empty((0,0))?
             self.areas[name].stimulus_beta[stim_name] = beta
 
         new_connectomes: Dict[str, ndarray] = {}
         for key in self.areas:
-            new_connectomes[key] = np.empty((0, 0))
+            new_connectomes[key] = np.empty((0, 0), dtype=np.float32)
             if key != name:
-                self.connectomes[key][name] = np.empty((0, 0))
+                self.connectomes[key][name] = np.empty((0, 0), dtype=np.float32)
             self.areas[key].area_beta[name] = self.areas[key].beta
             self.areas[name].area_beta[key] = beta
         self.connectomes[name] = new_connectomes
@@ -239,18 +297,15 @@ class Brain:
         logging.info(("Projecting " + ",".join(from_stimuli) + " and " + ",".join(from_areas) + " into " + area.name))
 
         name: str = area.name
-        prev_winner_inputs: List[float] = [0.] * area.support_size
+        prev_winner_inputs: ndarray = np.zeros(area.support_size, dtype=np.float32)
         for stim in from_stimuli:
-            stim_inputs = self.stimuli_connectomes[stim][name]
-            for i in range(area.support_size):
-                prev_winner_inputs[i] += stim_inputs[i]
+            prev_winner_inputs += self.stimuli_connectomes[stim][name]
         for from_area in from_areas:
             connectome = self.connectomes[from_area][name]
-            for w in self.areas[from_area].winners:
-                for i in range(area.support_size):
-                    prev_winner_inputs[i] += connectome[w][i]
+            assert connectome.dtype == np.float32, "connectome %s->%s is %s" % (from_area, name, connectome.dtype)
+            _add_winner_rows(prev_winner_inputs, connectome, np.asarray(self.areas[from_area].winners, dtype=np.intp))
 
-        logging.debug("prev_winner_inputs: %s" % prev_winner_inputs)
+        logging.debug("prev_winner_inputs: %s", prev_winner_inputs)
 
         # simulate area.k potential new winners
         total_k: int = 0
@@ -279,60 +334,55 @@ class Brain:
         mu = total_k * self.p
         a = float(alpha - mu) / std
         b = float(total_k - mu) / std  # note that b>=a and corresponds to the maximum value of Bin(total_k,self.p)
-        potential_new_winners = truncnorm.rvs(a, b, scale=std, loc=mu, size=area.k)
-        for i in range(area.k):
-            potential_new_winners[i] = round(potential_new_winners[i])
-        potential_new_winners = potential_new_winners.tolist()
+        potential_new_winners: ndarray = truncnorm.rvs(a, b, scale=std, loc=mu, size=area.k)
+        potential_new_winners = np.round(potential_new_winners).astype(np.float32)
 
-        logging.debug("potential_new_winners: %s" % potential_new_winners)
+        logging.debug("potential_new_winners: %s", potential_new_winners)
 
         # take max among prev_winner_inputs, potential_new_winners
         # get num_first_winners (think something small)
         # can generate area.new_winners, note the new indices
-        both = prev_winner_inputs + potential_new_winners
-        new_winner_indices = heapq.nlargest(area.k, list(range(len(both))), both.__getitem__)
-        num_first_winners = 0
-        first_winner_inputs = []
-        for i in range(area.k):
-            if new_winner_indices[i] >= area.support_size:  # index in potential_new_winners - a new assembly neuron
-                first_winner_inputs.append(potential_new_winners[new_winner_indices[i] - area.support_size])
-                new_winner_indices[i] = area.support_size + num_first_winners
-                num_first_winners += 1
-        area._new_winners = new_winner_indices  # Note that from here on 'new_winner_indices' is not in use.
+        both: ndarray = np.concatenate((prev_winner_inputs, potential_new_winners))
+        new_winner_indices = _top_k(both, area.k)
+        # indices past the support point into potential_new_winners - new assembly neurons, which are given the
+        # next free support indices in order
+        is_first_winner = new_winner_indices >= area.support_size
+        num_first_winners = int(np.count_nonzero(is_first_winner))
+        first_winner_inputs = potential_new_winners[new_winner_indices[is_first_winner] - area.support_size]
+        new_winner_indices[is_first_winner] = np.arange(area.support_size, area.support_size + num_first_winners)
+        area._new_winners = new_winner_indices.tolist()  # Note that from here on 'new_winner_indices' is not in use.
         area._new_support_size = area.support_size + num_first_winners
 
-        logging.debug("new_winners: %s" % area._new_winners)
+        logging.debug("new_winners: %s", area._new_winners)
 
         # for i in num_first_winners
         # generate where input came from
         # 	1) can sample input from array of size total_k, use ranges
         # 	2) can use stars/stripes method: if m total inputs, sample (m-1) out of total_k
         first_winner_to_inputs: Dict[int, ndarray] = {}
+        input_ends = np.cumsum(input_sizes)  # input j owns the sampled indices in [input_ends[j-1], input_ends[j])
         for i in range(num_first_winners):
             input_indices = random.sample(range(0, total_k), int(first_winner_inputs[i]))
-            inputs: ndarray = np.zeros(len(input_sizes))
-            total_so_far = 0
-            for j in range(len(input_sizes)):
-                # inputs[j] is the randomly generated number of connections from the j'th input to area i.
-                inputs[j] = sum([((total_so_far + input_sizes[j]) > w >= total_so_far) for w in input_indices])
-                total_so_far += input_sizes[j]
+            # inputs[j] is the randomly generated number of connections from the j'th input to area i.
+            inputs: ndarray = np.bincount(np.searchsorted(input_ends, input_indices, side='right'),
+                                          minlength=len(input_sizes))
             first_winner_to_inputs[i] = inputs
-            logging.debug("for first_winner #%d with input %s split as so: %s" % (i, first_winner_inputs[i], inputs))
+            logging.debug("for first_winner #%d with input %s split as so: %s", i, first_winner_inputs[i], inputs)
 
+        new_winners = np.asarray(area._new_winners, dtype=np.intp)
         m = 0
         # connectome for each stim->area
         # add num_first_winners cells, sampled input * (1+beta)
         # for i in repeat_winners, stimulus_inputs[i] *= (1+beta)
         for stim in from_stimuli:
+            stim_connectome = self.stimuli_connectomes[stim][name]
             if num_first_winners > 0:
-                self.stimuli_connectomes[stim][name] = np.resize(self.stimuli_connectomes[stim][name],
-                                                                 area.support_size + num_first_winners)
+                stim_connectome = np.resize(stim_connectome, area._new_support_size)
+                self.stimuli_connectomes[stim][name] = stim_connectome
             for i in range(num_first_winners):
-                self.stimuli_connectomes[stim][name][area.support_size + i] = first_winner_to_inputs[i][m]
-            stim_to_area_beta = area.stimulus_beta[stim]
-            for i in area._new_winners:
-                self.stimuli_connectomes[stim][name][i] *= (1 + stim_to_area_beta)
-            logging.debug("stimulus %s now looks like: %s" % (stim, self.stimuli_connectomes[stim][name]))
+                stim_connectome[area.support_size + i] = first_winner_to_inputs[i][m]
+            stim_connectome[new_winners] *= np.float32(1 + area.stimulus_beta[stim])
+            logging.debug("stimulus %s now looks like: %s", stim, stim_connectome)
             m += 1
 
         # connectome for each in_area->area
@@ -342,41 +392,38 @@ class Brain:
         for from_area in from_areas:
             from_area_w = self.areas[from_area].support_size
             from_area_winners = self.areas[from_area].winners
-            self.connectomes[from_area][name] = np.pad(self.connectomes[from_area][name],
-                                                       ((0, 0), (0, num_first_winners)),
-                                                       'constant', constant_values=0)
+            connectome = np.pad(self.connectomes[from_area][name], ((0, 0), (0, num_first_winners)),
+                                'constant', constant_values=0)
+            self.connectomes[from_area][name] = connectome
             for i in range(num_first_winners):
                 total_in = first_winner_to_inputs[i][m]
                 sample_indices = random.sample(from_area_winners, int(total_in))
-                for j in range(from_area_w):
-                    if j in sample_indices:
-                        self.connectomes[from_area][name][j][area.support_size + i] = 1
-                    if j not in from_area_winners:
-                        self.connectomes[from_area][name][j][area.support_size + i] = np.random.binomial(1, self.p)
-            area_to_area_beta = area.area_beta[from_area]
-            for i in area._new_winners:
-                for j in from_area_winners:
-                    self.connectomes[from_area][name][j][i] *= (1.0 + area_to_area_beta)
-            logging.debug("Connectome of %s to %s is now %s" % (from_area, name, self.connectomes[from_area][name]))
+                # sampled winners are connected, other winners are not, and the rest of the support is random
+                column = _bernoulli(from_area_w, self.p)
+                column[from_area_winners] = 0
+                column[sample_indices] = 1
+                connectome[:from_area_w, area.support_size + i] = column
+            from_winners = np.asarray(from_area_winners, dtype=np.intp)
+            _scale_winner_block(connectome, from_winners, new_winners, np.float32(1.0 + area.area_beta[from_area]))
+            logging.debug("Connectome of %s to %s is now %s", from_area, name, connectome)
             m += 1
 
         # expand connectomes from other areas that did not fire into area
         # also expand connectome for area->other_area
+        out_connectomes = self.connectomes[name]
         for other_area in self.areas:
             if other_area not in from_areas:
-                self.connectomes[other_area][name] = np.pad(self.connectomes[other_area][name],
-                                                            ((0, 0), (0, num_first_winners)), 'constant',
-                                                            constant_values=0)
-                for j in range(self.areas[other_area].support_size):
-                    for i in range(area.support_size, area._new_support_size):
-                        self.connectomes[other_area][name][j][i] = np.random.binomial(1, self.p)
+                other_support_size = self.areas[other_area].support_size
+                connectome = np.pad(self.connectomes[other_area][name], ((0, 0), (0, num_first_winners)),
+                                    'constant', constant_values=0)
+                connectome[:other_support_size, area.support_size:] = \
+                    _bernoulli((other_support_size, num_first_winners), self.p)
+                self.connectomes[other_area][name] = connectome
             # add num_first_winners rows, all bernoulli with probability p
-            self.connectomes[name][other_area] = np.pad(self.connectomes[name][other_area],
-                                                        ((0, num_first_winners), (0, 0)), 'constant', constant_values=0)
-            columns = len(self.connectomes[name][other_area][0])
-            for i in range(area.support_size, area._new_support_size):
-                for j in range(columns):
-                    self.connectomes[name][other_area][i][j] = np.random.binomial(1, self.p)
-            logging.debug("Connectome of %s to %s is now: %s" % (name, other_area, self.connectomes[name][other_area]))
+            connectome = np.pad(out_connectomes[other_area], ((0, num_first_winners), (0, 0)), 'constant',
+                                constant_values=0)
+            connectome[area.support_size:] = _bernoulli((num_first_winners, connectome.shape[1]), self.p)
+            out_connectomes[other_area] = connectome
+            logging.debug("Connectome of %s to %s is now: %s", name, other_area, connectome)
 
         return num_first_winners